@@ -1,19 +1,69 @@
-import base64
-import json
+from __future__ import annotations
+
+import binascii
+import itertools
 import os
+import re
+import shutil
+import tempfile
 from getpass import getpass
+from typing import Iterator, Optional
 from urllib.parse import urljoin
 
+import orjson
 import requests
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from rich.prompt import Prompt
 from rich.status import Status
-from selenium import webdriver
-from selenium.webdriver import ChromeOptions
-from selenium.webdriver.common.print_page_options import PrintOptions
 
 BASE_URL = "https://www.gradescope.com"
+CHROME_DISK_CACHE_SIZE = 128 * 1024 * 1024
+# same layout as selenium's default print options (letter paper with 1cm margins)
+PDF_OPTIONS = {
+    "printBackground": True,
+    "paperWidth": 8.5,
+    "paperHeight": 11,
+    "marginTop": 1 / 2.54,
+    "marginBottom": 1 / 2.54,
+    "marginLeft": 1 / 2.54,
+    "marginRight": 1 / 2.54,
+    "transferMode": "ReturnAsStream",
+}
+PDF_CHUNK_SIZE = 1 << 20
+AUTHENTICITY_TOKEN_RE = re.compile(
+    rb'name="authenticity_token"[^>]*?value="([^"]+)"'
+    rb'|value="([^"]+)"[^>]*?name="authenticity_token"'
+)
+
+
+def _chrome_profile_dir() -> str:
+    """
+    Directory for persistent browser profiles, keeping the http cache between runs.
+
+    This is in the user's cache directory, since the profiles store login cookies.
+    """
+    if os.name == "nt":
+        cache_dir = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "gradescope-export", "chrome-profiles")
+
+
+def _chrome_options(profile_dir: str):
+    """
+    Retrieve options for a headless chrome browser using the given profile directory.
+    """
+    from selenium.webdriver import ChromeOptions
+
+    options = ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument(f"--user-data-dir={profile_dir}")
+    options.add_argument(f"--disk-cache-dir={os.path.join(profile_dir, 'cache')}")
+    options.add_argument(f"--disk-cache-size={CHROME_DISK_CACHE_SIZE}")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--disable-dev-shm-usage")
+    return options
 
 
 class GradescopeWebDriver:
@@ -21,21 +71,69 @@ class GradescopeWebDriver:
     Gradescope access through a selenium chrome webdriver.
     """
 
-    def __init__(self, cookie_file=None):
+    # ids for browser profiles; chrome cannot share a profile between running browsers
+    _profile_ids = itertools.count()
+
+    def __init__(
+        self,
+        cookie_file=None,
+        session: Optional[requests.Session] = None,
+        pool_size: int = 4,
+    ):
+        """
+        @param cookie_file - the file to restore and save login cookies from
+        @param session - an already logged in session to share; None to log in anew.
+        @param pool_size - the number of connections to keep alive at once
+        """
+        # selenium is slow to import, so defer it until a browser is needed
+        from selenium import webdriver
+        from selenium.common.exceptions import WebDriverException
+
         # load environment variables
         load_dotenv()
 
-        options = ChromeOptions()
-        options.add_argument("--headless=new")
-        self.driver = webdriver.Chrome(options=options)
+        profiles_dir = _chrome_profile_dir()
+        os.makedirs(profiles_dir, mode=0o700, exist_ok=True)
+        profile_dir = os.path.join(profiles_dir, str(next(self._profile_ids)))
+        # throwaway profile, removed when the browser is closed
+        self._temp_profile_dir: Optional[str] = None
+        try:
+            self.driver = webdriver.Chrome(options=_chrome_options(profile_dir))
+        except WebDriverException as err:
+            if "already in use" not in str(err):
+                raise
+            # another running browser (e.g. from a concurrent run) has the profile
+            self._temp_profile_dir = tempfile.mkdtemp(prefix="gradescope-export-")
+            self.driver = webdriver.Chrome(
+                options=_chrome_options(self._temp_profile_dir)
+            )
 
         self.cookie_file = cookie_file
+        # scripts to run on every page load
+        self.page_scripts: list[str] = []
+
+        if session is not None:
+            # reuse the existing login
+            self.session = session
+            self._copy_cookies_to_driver(self.session.cookies.get_dict())
+            return
+
+        # persistent session, so that connections to gradescope are reused
+        self.session = requests.Session()
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        )
 
         # login user
-        self.login(
-            email=os.environ.get("GRADESCOPE_EMAIL", None),
-            password=os.environ.get("GRADESCOPE_PASSWORD", None),
-        )
+        try:
+            self.login(
+                email=os.environ.get("GRADESCOPE_EMAIL", None),
+                password=os.environ.get("GRADESCOPE_PASSWORD", None),
+            )
+        except BaseException:
+            # don't leave the browser (and any throwaway profile) behind
+            self.quit()
+            raise
 
     def login(self, email: str, password: str):
         """
@@ -53,23 +151,19 @@ class GradescopeWebDriver:
             status.start()
 
             # load cookies
-            with open(self.cookie_file, "r", encoding="utf-8") as in_file:
-                cookies = json.load(in_file)
+            with open(self.cookie_file, "rb") as in_file:
+                cookies = orjson.loads(in_file.read())
 
-            # visit base url to set cookies
-            self.visit(BASE_URL)
-            for name, value in cookies.items():
-                self.driver.add_cookie({"name": name, "value": value})
+            self._copy_cookies_to_driver(cookies)
 
             # ensure that the user is actually logged in
             status.update("Ensuring user is logged in")
-            session = requests.Session()
-            session.cookies.update(cookies)
+            self.session.cookies.update(cookies)
 
-            response = session.get(login_url, timeout=20)
+            response = self.session.get(login_url, timeout=20)
             status.stop()
             try:
-                json_response = json.loads(response.content)
+                json_response = orjson.loads(response.content)
                 # should give {"warning":"You must be logged out to access this page."}
                 if (
                     json_response["warning"]
@@ -77,14 +171,15 @@ class GradescopeWebDriver:
                 ):
                     # all good to go
                     return True
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 # invalid json, so use html
                 pass
 
-            soup = BeautifulSoup(response.content, "html.parser")
-            login_btn = soup.find("input", {"value": "Log In", "type": "submit"})
-
-            if login_btn is None:
+            # a plain substring check is enough to detect the login button
+            if (
+                b'value="Log In"' not in response.content
+                or b'type="submit"' not in response.content
+            ):
                 # form does not show, so stop and return
                 return True
 
@@ -98,16 +193,15 @@ class GradescopeWebDriver:
         status = Status("Logging in")
         status.start()
 
-        # visit login page
-        session = requests.Session()
-        response = session.get(login_url, timeout=20)
-
-        soup = BeautifulSoup(response.content, "html.parser")
+        # visit login page, discarding any stale cookies
+        self.session.cookies.clear()
+        response = self.session.get(login_url, timeout=20)
 
         # get authenticity token from form
-        form = soup.find("form")
-        token_input = form.find("input", {"name": "authenticity_token"})
-        token = token_input.get("value")
+        token_match = AUTHENTICITY_TOKEN_RE.search(response.content)
+        if token_match is None:
+            raise RuntimeError("Failed to log in; could not find authenticity token.")
+        token = (token_match.group(1) or token_match.group(2)).decode()
 
         # prepare payload and headers
         payload = {
@@ -125,51 +219,130 @@ class GradescopeWebDriver:
             "Referer": login_url,
         }
         # login
-        response = session.post(login_url, data=payload, headers=headers, timeout=20)
+        response = self.session.post(
+            login_url, data=payload, headers=headers, timeout=20
+        )
         if not response.ok:
             raise RuntimeError(
                 f"Failed to log in; (status {response.status_code})\nReponse: {response.content}"
             )
         # also check content
-        page = BeautifulSoup(response.content, "html.parser")
-        spans = page.select(".alert-error span")
-        if any("Invalid email/password combination" in span.text for span in spans):
+        if b"Invalid email/password combination" in response.content:
             raise RuntimeError("Failed to log in; invalid email/password combination.")
 
-        # let driver go to base url to assign cookies
-        self.visit(BASE_URL)
-
         # copy over all cookies to the chrome webdriver
-        for name, value in session.cookies.items():
-            self.driver.add_cookie({"name": name, "value": value})
+        self._copy_cookies_to_driver(self.session.cookies.get_dict())
 
         if self.cookie_file is not None:
-            # save cookies as json
-            with open(self.cookie_file, "w", encoding="utf-8") as out_file:
-                json.dump(session.cookies.get_dict(), out_file)
+            # save cookies as json, atomically replacing any existing file
+            tmp_cookie_file = self.cookie_file + ".tmp"
+            with open(tmp_cookie_file, "wb", buffering=64 * 1024) as out_file:
+                out_file.write(orjson.dumps(self.session.cookies.get_dict()))
+            os.replace(tmp_cookie_file, self.cookie_file)
 
         status.stop()
         return True
 
+    def _copy_cookies_to_driver(self, cookies: dict[str, str]):
+        """
+        Copy the given cookies into the selenium webdriver.
+        """
+        # set all cookies in a single call, rather than one call per cookie;
+        # unlike add_cookie, this does not need the browser to be on the site
+        self.driver.execute_cdp_cmd(
+            "Network.setCookies",
+            {
+                "cookies": [
+                    {"name": name, "value": value, "url": BASE_URL}
+                    for name, value in cookies.items()
+                ]
+            },
+        )
+
+    def fork(self) -> "GradescopeWebDriver":
+        """
+        Create a new webdriver with its own browser, sharing the current login.
+
+        Selenium webdrivers cannot be used from multiple threads at once,
+        so each thread should use its own fork.
+        """
+        forked = GradescopeWebDriver(cookie_file=self.cookie_file, session=self.session)
+        for script in self.page_scripts:
+            forked.add_page_script(script)
+        return forked
+
+    def quit(self):
+        """
+        Close the browser.
+        """
+        self.driver.quit()
+        if self._temp_profile_dir is not None:
+            shutil.rmtree(self._temp_profile_dir, ignore_errors=True)
+
     def visit(self, url: str):
         """Visit a URL."""
         self.driver.get(url)
 
-    def print(self, output_file=None) -> bytes:
+    def print(self, output_file=None) -> Optional[bytes]:
         """
         Print the current page to a PDF.
 
         @param output_file - the file to save the PDF into; None if no output file.
+        @return the PDF contents if there is no output file, otherwise None.
+        """
+        # render with screen styles, which gradescope otherwise hides from print
+        self.driver.execute_cdp_cmd("Emulation.setEmulatedMedia", {"media": "screen"})
+
+        # print through chrome directly, reading the PDF back as a stream
+        result = self.driver.execute_cdp_cmd("Page.printToPDF", PDF_OPTIONS)
+        handle = result["stream"]
+        try:
+            if output_file is None:
+                return b"".join(self._read_stream(handle))
+
+            # write each chunk as it arrives, atomically replacing the file when done
+            tmp_output_file = output_file + ".tmp"
+            try:
+                with open(tmp_output_file, "wb", buffering=PDF_CHUNK_SIZE) as out:
+                    for data in self._read_stream(handle):
+                        out.write(data)
+                os.replace(tmp_output_file, output_file)
+            except BaseException:
+                # don't leave a partial PDF behind
+                if os.path.exists(tmp_output_file):
+                    os.remove(tmp_output_file)
+                raise
+            return None
+        finally:
+            self.driver.execute_cdp_cmd("IO.close", {"handle": handle})
+
+    def _read_stream(self, handle: str) -> Iterator[bytes]:
+        """
+        Read a CDP stream in chunks, until the end of the stream.
         """
-        print_options = PrintOptions()
-        print_options.background = True
-        pdf = base64.b64decode(self.driver.print_page(print_options=print_options))
+        while True:
+            chunk = self.driver.execute_cdp_cmd(
+                "IO.read", {"handle": handle, "size": PDF_CHUNK_SIZE}
+            )
+            if chunk.get("base64Encoded", False):
+                yield binascii.a2b_base64(chunk["data"])
+            else:
+                yield chunk["data"].encode()
+            if chunk["eof"]:
+                break
+
+    def add_page_script(self, script: str):
+        """
+        Register javascript to run on every page loaded from now on.
 
-        # write to file if specified
-        if output_file is not None:
-            with open(output_file, "wb") as out:
-                out.write(pdf)
-        return pdf
+        The script is only sent to the browser once, rather than on every page.
+        """
+        if not self.page_scripts:
+            self.driver.execute_cdp_cmd("Page.enable", {})
+        self.driver.execute_cdp_cmd(
+            "Page.addScriptToEvaluateOnNewDocument", {"source": script}
+        )
+        self.page_scripts.append(script)
 
     def execute_script(self, script):
         """
@@ -2,33 +2,32 @@
 Export Gradescope online assignments to a PDF file.
 """
 
+from __future__ import annotations
+
 import os
+import queue
 import re
-from typing import Optional, TypedDict
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Optional, TypedDict, Union
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
+import requests
 from rich import print as pprint
 from rich.console import Console
-from rich.progress import (
-    BarColumn,
-    Column,
-    Progress,
-    SpinnerColumn,
-    TaskID,
-    TaskProgressColumn,
-    TextColumn,
-    TimeRemainingColumn,
-)
 from rich.prompt import Prompt
 from rich.status import Status
 
 from api.client import BASE_URL, GradescopeWebDriver
 
+if TYPE_CHECKING:
+    from rich.progress import Progress, TaskID
+
 CONSOLE = Console(highlight=False)
+COURSE_ID_RE = re.compile(r".*/courses/(\d+)")
 CSS_UPDATE = """
-document.body.innerHTML = document.getElementsByClassName("onlineAssignment")[0].parentElement.innerHTML;
-for (const link of document.head.getElementsByTagName("link")) {link.removeAttribute("media");}
+// move the assignment nodes directly, rather than reserializing them through innerHTML
+document.body.replaceChildren(...document.getElementsByClassName("onlineAssignment")[0].parentElement.childNodes);
 // remove messages
 for (const msg of document.getElementsByClassName("msg")) {msg.remove();}
 """.strip()
@@ -40,6 +39,14 @@ for (const inp of document.getElementsByTagName("input")) {inp.checked = false;
 // remove fill in the blank answers
 for (const text of document.getElementsByClassName("form--textInput")) {text.innerHTML = "";}
 """.strip()
+# run scripts after the page has fully loaded (as driver.get waits for),
+# only on online assignment pages
+ONLINE_ASSIGNMENT_PAGE_SCRIPT = """
+window.addEventListener("load", () => {{
+if (document.getElementsByClassName("onlineAssignment").length === 0) {{return;}}
+{script}
+}});
+""".strip()
 
 
 class AssignmentType(TypedDict):
@@ -55,6 +62,16 @@ def custom_progress_context() -> Progress:
 
     Modifies the default context by adding a spinner and making the description full width.
     """
+    from rich.progress import (
+        BarColumn,
+        Column,
+        Progress,
+        SpinnerColumn,
+        TaskProgressColumn,
+        TextColumn,
+        TimeRemainingColumn,
+    )
+
     return Progress(
         SpinnerColumn(),
         # update to full width (very high ratio)
@@ -66,63 +83,96 @@ def custom_progress_context() -> Progress:
         TimeRemainingColumn(),
         expand=True,
         transient=True,
+        # fewer redraws, since updates come in from many worker threads
+        refresh_per_second=4,
         console=CONSOLE,
     )
 
 
-def is_online_assignment(content: str):
+def _class_xpath(tag: str, class_name: str) -> str:
+    """
+    Build an XPath expression matching all `tag` elements with the given class.
+
+    Equivalent to the CSS selector `tag.class_name`, without requiring cssselect.
+    """
+    return (
+        f"//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')]"
+    )
+
+
+def is_online_assignment(content: Union[str, bytes]):
     """
     Check whether the given page content is for an online assignment.
     """
-    outline_soup = BeautifulSoup(content, "html.parser")
-    assignment_div = outline_soup.find("div", {"class": "onlineAssignment"})
-    return assignment_div is not None
+    from lxml import html as lxml_html
+
+    root = lxml_html.fromstring(content)
+    assignment_divs = root.xpath(_class_xpath("div", "onlineAssignment"))
+    return len(assignment_divs) > 0
+
+
+def update_css_on_load(driver: GradescopeWebDriver, no_solutions: bool = False):
+    """
+    Update the CSS of every online assignment page as it is loaded in the browser.
+    """
+    script = CSS_UPDATE
+    if no_solutions:
+        # remove all solutions as well
+        script += "\n" + QUESTION_ONLY_CSS_UPDATE
+    driver.add_page_script(ONLINE_ASSIGNMENT_PAGE_SCRIPT.format(script=script))
+
+
+def check_online_assignment_url(driver: GradescopeWebDriver, url: str):
+    """
+    Check whether the given URL is for an online assignment.
+
+    The page is fetched through the logged in requests session rather than the browser,
+    since a full page load is much slower.
+    """
+    response = driver.session.get(url, timeout=20)
+    # fail loudly rather than treating errors (e.g. rate limits) as other assignments
+    response.raise_for_status()
+    return is_online_assignment(response.content)
 
 
 def export_current_page(
     driver: GradescopeWebDriver,
     folder: str,
     assignment: AssignmentType,
-    no_solutions: bool = False,
     progress: Optional[Progress] = None,
     task: Optional[TaskID] = None,
 ):
     """
     Export the current page to a PDF.
+
+    The page is expected to already be checked to be an online assignment
+    (see `check_online_assignment_url`), with its CSS updated on load.
     """
-    if is_online_assignment(driver.get_content()):
-        # update CSS
-        if progress is not None and task is not None:
-            progress.update(task, description="Updating page CSS")
-
-        driver.execute_script(CSS_UPDATE)
-        if no_solutions:
-            # remove all solutions as well
-            driver.execute_script(QUESTION_ONLY_CSS_UPDATE)
-        pdf_file = os.path.join(folder, assignment["name"] + ".pdf")
-
-        # save file
-        if progress is not None and task is not None:
-            progress.update(
-                task,
-                description=f"Printing to [green]{pdf_file}[/green]",
-            )
-        driver.print(pdf_file)
-        CONSOLE.print(f"Saved to [green]{pdf_file}[/green]")
-
-
-def crawl_assignments(
-    driver: GradescopeWebDriver, folder: str, no_solutions: bool = False
-):
+    pdf_file = os.path.join(folder, assignment["name"] + ".pdf")
+
+    # save file
+    if progress is not None and task is not None:
+        progress.update(
+            task,
+            description=f"Printing to [green]{pdf_file}[/green]",
+        )
+    driver.print(pdf_file)
+    CONSOLE.print(f"Saved to [green]{pdf_file}[/green]")
+
+
+def crawl_assignments(driver: GradescopeWebDriver, folder: str, workers: int = 4):
     """
     Crawl through all assignments in a gradescope course,
     checking whether the assignment is an online assignment, and exporting it to a PDF.
+
+    Assignments are exported concurrently, with each of the `workers` threads
+    using its own browser.
     """
     course_url: str = Prompt.ask("Gradescope course URL", console=CONSOLE)
 
     # normalize to ensure the URL ends in /assignments
     while "assignments" not in course_url:
-        course_id_match = re.match(r".*/courses/(\d+)", course_url)
+        course_id_match = COURSE_ID_RE.match(course_url)
         if not course_id_match:
             pprint("[red]Invalid course URL[/red]")
             course_url: str = Prompt.ask("Gradescope course URL", console=CONSOLE)
@@ -142,85 +192,175 @@ def crawl_assignments(
     content = driver.get_content()
     status.stop()
 
-    assignments_soup = BeautifulSoup(content, "html.parser")
-    links = assignments_soup.select("div.table--primaryLink a")
+    from lxml import html as lxml_html
+
+    root = lxml_html.fromstring(content)
+    links = root.xpath(_class_xpath("div", "table--primaryLink") + "//a")
     assignments: list[AssignmentType] = [
-        {"url": link["href"], "name": link.get_text()} for link in links
+        {"url": link.get("href"), "name": link.text_content()} for link in links
     ]
+    # deduplicate names, so that concurrent exports never write to the same file
+    used_names: set[str] = set()
+    for assignment in assignments:
+        name = assignment["name"]
+        suffix = 2
+        while name.casefold() in used_names:
+            name = f"{assignment['name']} ({suffix})"
+            suffix += 1
+        used_names.add(name.casefold())
+        assignment["name"] = name
+
+    # idle webdrivers, each usable by a single thread at a time
+    idle_drivers: "queue.SimpleQueue[GradescopeWebDriver]" = queue.SimpleQueue()
+    idle_drivers.put(driver)
+    forked_drivers: list[GradescopeWebDriver] = []
+    forked_drivers_lock = threading.Lock()
+    # progress task for each worker thread
+    worker_tasks = threading.local()
+
     progress_context = custom_progress_context()
     with progress_context as progress:
         task = progress.add_task("Crawling assignments", total=len(assignments))
-        for assignment in assignments:
-            progress.update(
-                task,
-                advance=1,
-                description=f"Crawling assignments ({assignment['name']})",
-            )
 
+        def export_assignment(assignment: AssignmentType):
             assignment_url = urljoin(BASE_URL, assignment["url"])
             outline_url = urljoin(assignment_url + "/", "outline/edit")
             pretty_url = urljoin(assignment["url"] + "/", "outline/edit")
-            assignment_task = progress.add_task(
-                f"Visiting [blue]{pretty_url}[/blue]", total=None
-            )
-
-            driver.visit(outline_url)
-            # export the page
-            export_current_page(
-                driver,
-                folder,
-                no_solutions=no_solutions,
-                assignment=assignment,
-                progress=progress,
-                task=assignment_task,
-            )
-
-            # done with the task, remove it
-            progress.remove_task(assignment_task)
+            # reuse one task per worker thread, rather than adding one per assignment
+            assignment_task = getattr(worker_tasks, "task", None)
+            if assignment_task is None:
+                assignment_task = progress.add_task(
+                    f"Checking [blue]{pretty_url}[/blue]", total=None
+                )
+                worker_tasks.task = assignment_task
+            else:
+                progress.update(
+                    assignment_task,
+                    description=f"Checking [blue]{pretty_url}[/blue]",
+                    visible=True,
+                )
+
+            try:
+                try:
+                    if not check_online_assignment_url(driver, outline_url):
+                        return
+                except requests.HTTPError as err:
+                    status_code = err.response.status_code
+                    if status_code == 429 or status_code >= 500:
+                        # affects every request, so stop crawling
+                        raise
+                    CONSOLE.print(
+                        f"[red]Failed to load {assignment['name']}[/red] ({err})"
+                    )
+                    return
+
+                try:
+                    worker_driver = idle_drivers.get_nowait()
+                except queue.Empty:
+                    # all webdrivers are busy, so start up a new one
+                    worker_driver = driver.fork()
+                    with forked_drivers_lock:
+                        forked_drivers.append(worker_driver)
+
+                try:
+                    progress.update(
+                        assignment_task,
+                        description=f"Visiting [blue]{pretty_url}[/blue]",
+                    )
+                    worker_driver.visit(outline_url)
+                    # export the page
+                    export_current_page(
+                        worker_driver,
+                        folder,
+                        assignment=assignment,
+                        progress=progress,
+                        task=assignment_task,
+                    )
+                finally:
+                    idle_drivers.put(worker_driver)
+            finally:
+                # hide the task until this thread picks up another assignment
+                progress.update(assignment_task, visible=False)
+                progress.update(task, advance=1)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(export_assignment, assignment)
+                    for assignment in assignments
+                ]
+                try:
+                    for future in as_completed(futures):
+                        # propagate any errors from the worker threads
+                        future.result()
+                except BaseException:
+                    # stop any queued exports, rather than waiting for all of them
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            for forked_driver in forked_drivers:
+                forked_driver.quit()
 
 
 def main(
-    export_all=False, folder="pdf", cookie_file="cookies.json", no_solutions=False
+    export_all=False,
+    folder="pdf",
+    cookie_file="cookies.json",
+    no_solutions=False,
+    workers=4,
 ):
     """
     Main method. Calls various other functions depending on the arguments to the export script.
     """
-    driver = GradescopeWebDriver(cookie_file=cookie_file)
+    # one connection for each worker thread
+    driver = GradescopeWebDriver(cookie_file=cookie_file, pool_size=workers)
+    try:
+        update_css_on_load(driver, no_solutions=no_solutions)
 
-    if export_all:
-        crawl_assignments(driver, folder=folder, no_solutions=no_solutions)
-    else:
-        while True:
-            url = Prompt.ask("Gradescope online assignment URL")
-            status = Status(f"Visiting [blue]{url}[/blue]", console=CONSOLE)
-            status.start()
+        if export_all:
+            crawl_assignments(driver, folder=folder, workers=workers)
+        else:
+            while True:
+                url = Prompt.ask("Gradescope online assignment URL")
+                status = Status(
+                    f"Checking whether [blue]{url}[/blue] is an online assignment",
+                    console=CONSOLE,
+                )
+                status.start()
+                try:
+                    if check_online_assignment_url(driver, url):
+                        break
+                except requests.RequestException as err:
+                    # e.g. error responses, invalid URLs or network errors
+                    status.stop()
+                    CONSOLE.print(f"[red]Failed to load assignment[/red] ({err})")
+                    continue
+                status.stop()
+                CONSOLE.print(
+                    "[red]Not an online assignment link[/red]; "
+                    "make sure you give a link to the outline page "
+                    "(ending in [blue]/outline/edit[/blue])."
+                )
+            # only load the page in the browser once it is an online assignment
+            status.update(f"Visiting [blue]{url}[/blue]")
             driver.visit(url)
-            status.update("Checking whether this is an online assignment")
-            if is_online_assignment(driver.get_content()):
-                break
-            CONSOLE.print(
-                "[red]Not an online assignment link[/red]; "
-                "make sure you give a link to the outline page "
-                "(ending in [blue]/outline/edit[/blue])."
-            )
-        status.update("Updating page CSS")
-        driver.execute_script(CSS_UPDATE)
-        if no_solutions:
-            # remove all solutions as well
-            driver.execute_script(QUESTION_ONLY_CSS_UPDATE)
-        status.stop()
-
-        input_pdf_file = Prompt.ask("Output PDF filename", console=CONSOLE)
-        if os.path.splitext(input_pdf_file)[1] != ".pdf":
-            input_pdf_file += ".pdf"
-
-        pdf_file = os.path.join(folder, input_pdf_file)
-        status.update(status=f"Printing to [green]{pdf_file}[/green]")
-        status.start()
-        driver.print(pdf_file)
-        status.stop()
-        CONSOLE.print(f"Saved to [green]{pdf_file}[/green]")
+            status.stop()
+
+            input_pdf_file = Prompt.ask("Output PDF filename", console=CONSOLE)
+            if os.path.splitext(input_pdf_file)[1] != ".pdf":
+                input_pdf_file += ".pdf"
 
+            pdf_file = os.path.join(folder, input_pdf_file)
+            status.update(status=f"Printing to [green]{pdf_file}[/green]")
+            status.start()
+            driver.print(pdf_file)
+            status.stop()
+            CONSOLE.print(f"Saved to [green]{pdf_file}[/green]")
+
+    finally:
+        # close the browser, removing any throwaway profile
+        driver.quit()
 
 if __name__ == "__main__":
     import argparse
@@ -245,11 +385,20 @@ if __name__ == "__main__":
         default="cookies.json",
         help="Output folder for saved cookies",
     )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        default=4,
+        help="Number of browsers to export with concurrently when using --all",
+    )
     args = parser.parse_args()
     assert os.path.isdir(args.folder), "Invalid output folder"
+    assert args.workers > 0, "Invalid number of workers"
     main(
         export_all=args.all,
         folder=args.folder,
         cookie_file=args.cookies,
         no_solutions=args.no_solutions,
+        workers=args.workers,
     )